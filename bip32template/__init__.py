@@ -18,19 +18,24 @@
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
 
-# pylama: ignore=C901,E731,E221
-
-try:
+# pylama: ignore=C901
+
+from array import array
+
+# typing module is needed only for the type checkers, and is not imported
+# otherwise. Importing it takes noticeable time and memory, especially
+# on constrained devices. Annotations that use its names are quoted,
+# so they are not evaluated at runtime. micropython ignores annotations,
+# and has no __future__ module to use `from __future__ import annotations`.
+# Type checkers treat TYPE_CHECKING as true regardless of its value here.
+TYPE_CHECKING = False
+if TYPE_CHECKING:
     from typing import (
-        List, Tuple, Sequence, Iterable, Optional, NoReturn, Type, Any, Union,
-        TypeVar, cast
+        List, Tuple, Sequence, Iterable, Optional, Type, Any, TypeVar,
+        Callable
     )
-    HAS_TYPING = True
-except ImportError:
-    HAS_TYPING = False
-    # mypy 0.761 does not complain here,
-    # but complains if we use `def cast(x,y):`
-    cast = lambda x, y: y
+    T_BIP32Template = TypeVar('T_BIP32Template', bound='BIP32Template')
+    from ._parser import _ParseRanges
 
 HARDENED_INDEX_START = 0x80000000
 MAX_INDEX_VALUE = (HARDENED_INDEX_START-1)
@@ -43,8 +48,8 @@ class BIP32TemplateException(Exception):
     message = "generic template exception"
     position = None
 
-    def __init__(self, message: Optional[str] = None,
-                 position: Optional[int] = None) -> None:
+    def __init__(self, message: 'Optional[str]' = None,
+                 position: 'Optional[int]' = None) -> None:
         self.position = position
         if message is not None:
             self.message = message
@@ -138,41 +143,56 @@ class BIP32TemplateExceptionInconsistentRange(BIP32TemplateException):
                "indexes in one range tuple)")
 
 
-def _assert_never(x: NoReturn) -> NoReturn:
-    raise AssertionError('{} is not handled'.format(x))
+# The parser needs the constants and exception classes defined above
+from ._parser import parse_template as _parse_template  # noqa: E402
 
-# These classes emulate what we could do with Enum
-# With good Enum implementation, we could use mypy to check that all
-# enum variants are exhaustively checked with _assert_never function:
-# (see https://github.com/python/mypy/issues/6366)
-#
-# But micropyhthon does not have a working Enum implementation,
-# so we are emulating this for a time being and _assert_never is not
-# active in static typechecks
 
+def _bisect_right_py(a: 'Sequence[int]', x: int, lo: int, hi: int) -> int:
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if x < a[mid]:
+            hi = mid
+        else:
+            lo = mid + 1
+    return lo
 
-class State:
-    SECTION_START        = cast('State', object())
-    NEXT_SECTION         = cast('State', object())
-    RANGE_WITHIN_SECTION = cast('State', object())
-    SECTION_END          = cast('State', object())
-    VALUE                = cast('State', object())
 
+# If no section has more ranges than this, match() scans them linearly,
+# which is faster than the bisect calls (measured on CPython 3.11)
+_MATCH_MAX_LINEAR_RANGES = 8
 
-class Success:
-    SUCCESS = cast('Success', object())
+_bisect_right = \
+    _bisect_right_py  # type: Callable[[Sequence[int], int, int, int], int]
 
+try:
+    import bisect
+    _bisect_right = bisect.bisect_right
+except ImportError:
+    # micropython does not have bisect module
+    pass
+
+_numpy = None  # type: Any
 
-if HAS_TYPING:
-    T_BIP32Template = TypeVar('T_BIP32Template', bound='BIP32Template')
+
+def _get_numpy() -> 'Any':
+    # numpy is an optional dependency, and is not available on micropython.
+    # It is imported on first use, and via __import__() so that static
+    # type checks do not depend on numpy being installed
+    global _numpy
+    if _numpy is None:
+        try:
+            _numpy = __import__('numpy')
+        except ImportError:
+            _numpy = False
+    return _numpy
 
 
 class BIP32Template():
 
-    def __init__(self, _sections: Iterable[Iterable[Tuple[int, int]]], *,
+    def __init__(self, _sections: 'Iterable[Iterable[Tuple[int, int]]]', *,
                  is_partial: bool = False,
                  hardened_marker: str = HARDENED_MARKERS[0],
-                 _accept_params_as_is: bool = False
+                 _ranges: 'Optional[_ParseRanges]' = None
                  ) -> None:
 
         if not _sections:
@@ -181,17 +201,31 @@ class BIP32Template():
         if hardened_marker and hardened_marker not in HARDENED_MARKERS:
             raise BIP32TemplateExceptionUnexpectedHardenedMarker
 
-        sections = []  # type: List[List[Tuple[int, int]]]
-
-        if _accept_params_as_is:
-            sections = _sections  # type: ignore
+        # Ranges are stored as flat arrays of range starts and range ends.
+        # Ranges of section i are at [_offsets[i]:_offsets[i+1]] in them.
+        offsets = array('I', [0])
+
+        if _ranges is not None:
+            # The parser has already validated the ranges, and gives them
+            # in this layout, along with the hardened flags for the sections
+            # and the immutable view of `_sections`
+            r_starts, r_ends, r_offsets, r_hardened, sections = _ranges
+            starts = array('I', r_starts)
+            ends = array('I', r_ends)
+            offsets = array('I', r_offsets)
+            hardened_mask = list(r_hardened)
         else:
+            # Ranges are validated and stored in the arrays in one pass
+            starts = array('I')
+            ends = array('I')
+            hardened_mask = []
+            new_sections = []
             got_hardened = False
             got_unhardened = False
-            for s in _sections:
-                prev_r = None
+            for sec in _sections:
+                prev_end = -1
                 new_ranges = []
-                for r in s:
+                for r in sec:
                     if len(r) != 2 or not isinstance(r[0], int) \
                             or not isinstance(r[1], int):
                         raise ValueError(
@@ -206,7 +240,7 @@ class BIP32Template():
 
                     if start > end:
                         raise BIP32TemplateExceptionRangeOrderBad
-                    if prev_r is not None and prev_r[1] >= start:
+                    if prev_end >= start:
                         raise BIP32TemplateExceptionRangesIntersect
                     if start >= HARDENED_INDEX_START:
                         assert end >= HARDENED_INDEX_START  # checked above
@@ -219,415 +253,172 @@ class BIP32Template():
 
                         got_unhardened = True
 
-                    prev_r = r
+                    prev_end = end
 
-                    new_ranges.append((r[0], r[1]))
+                    starts.append(start)
+                    ends.append(end)
+                    # ranges given as tuples are kept, not re-created
+                    new_ranges.append(r if type(r) is tuple
+                                      else (start, end))
 
-                sections.append(new_ranges)
+                new_sections.append(tuple(new_ranges))
+                offsets.append(len(starts))
+                # the checks above ensure that all ranges of the section
+                # are hardened if the last one is hardened
+                hardened_mask.append(prev_end >= HARDENED_INDEX_START)
 
             assert got_hardened or got_unhardened
             if not got_hardened:
                 hardened_marker = ''
 
-        self.sections = sections
+            sections = tuple(new_sections)
+
         self.is_partial = is_partial
 
+        self._starts = starts
+        self._ends = ends
+        self._offsets = offsets
+        self._hardened_mask = hardened_mask  # type: List[bool]
+        # Immutable view of the same ranges, for `sections` and __str__
+        self._sections = \
+            sections  # type: Tuple[Tuple[Tuple[int, int], ...], ...]
+
+        # no section can be too long for the linear scan in match()
+        # if all sections together are not longer than that
+        self._match_with_bisect = (
+            len(starts) > _MATCH_MAX_LINEAR_RANGES
+            and any(len(s) > _MATCH_MAX_LINEAR_RANGES for s in sections))
+
+        self._np_section_ranges = None  # type: Any
+
         self.hardened_marker = hardened_marker
 
     @classmethod
-    def parse(cls: Type[T_BIP32Template], tpl: Iterable[str], *,
+    def parse(cls: 'Type[T_BIP32Template]', tpl: 'Iterable[str]', *,
               max_sections: int = 16,
               max_ranges_per_section: int = 8,
               is_format_onlypath: bool = False,
               is_format_unambiguous: bool = False,
-              hardened_markers: Tuple[str, str] = HARDENED_MARKERS
-              ) -> T_BIP32Template:
-
-        is_partial = True
-
-        state = State.SECTION_START  # type: State
-        ret_state = None  # type: Optional[State]
-        section_started = True
-
-        index_value = INVALID_INDEX
-        range_start = INVALID_INDEX
-        range_end = INVALID_INDEX
-        accepted_hardened_markers = set(hardened_markers)
+              hardened_markers: 'Tuple[str, str]' = HARDENED_MARKERS
+              ) -> 'T_BIP32Template':
 
-        tpl_iter = iter(tpl)
-
-        # structure for 0/{3-6,8}/2:
-        # [ [ (0,0) ], [ (3,6), (8,8) ], [ (2,2) ] ]
-        sections = []  # type: List[List[Tuple[int, int]]]
-
-        position = 0
-
-        def err(exc: Type[BIP32TemplateException]) -> NoReturn:
-            # micropython does not support arguments to exceptions,
-            # so we first create an instance of the exception, set the
-            # attribute, and then raise
-            e_inst = exc()
-            e_inst.position = position
-            raise e_inst
-
-        def get_num_ranges_in_last_section() -> int:
-            if section_started:
-                return 0
-            return len(sections[-1])
-
-        def raise_unexpected_char_error(c: Optional[str]) -> NoReturn:
-            if c is None:
-                err(BIP32TemplateExceptionUnexpectedFinish)
-            if c in ' \t':
-                err(BIP32TemplateExceptionUnexpectedSpace)
-            if c in "m/}{-,*h'" or c.isdigit():
-                err(BIP32TemplateExceptionUnexpectedCharacter)
-            err(BIP32TemplateExceptionInvalidCharacter)
-
-        def process_digit(c: str) -> int:
-            assert c.isdigit()
-
-            if index_value == 0:
-                err(BIP32TemplateExceptionIndexHasLeadingZero)
-
-            v = ord(c) - ord('0')
-
-            if index_value != INVALID_INDEX:
-                v = index_value * 10 + v
-
-            if v > MAX_INDEX_VALUE:
-                err(BIP32TemplateExceptionIndexTooBig)
+        if not isinstance(tpl, str):
+            chars = list(tpl)
+            for elt in chars:
+                if not isinstance(elt, str):
+                    raise ValueError(
+                        'encountered an element in tpl that is not a string')
+                if len(elt) != 1:
+                    raise ValueError(
+                        'encountered an element in tpl with len() != 1')
+            tpl = ''.join(chars)
 
-            return v
+        ranges, is_partial, hardened_marker = _parse_template(
+            tpl, max_sections, max_ranges_per_section,
+            is_format_onlypath, is_format_unambiguous,
+            tuple(hardened_markers))
 
-        def finalize_range() -> bool:
-            nonlocal range_start, range_end
+        return cls(ranges[4], is_partial=is_partial,
+                   hardened_marker=hardened_marker, _ranges=ranges)
 
-            if range_start != INVALID_INDEX:
-                if range_end != INVALID_INDEX:
-                    # Because we call this funcion from two different
-                    # FSM states (RANGE_WITHIN_SECTION and SECTION_END), and
-                    # we _change_ range variables here, range can already be
-                    # finalized when this function is called. The end of the
-                    # range should be the same as the index, though.
-                    assert range_end == index_value
-                    return False
+    @property
+    def sections(self) -> 'List[List[Tuple[int, int]]]':
+        """Ranges of the template sections, as lists of (start, end) tuples.
+        This is a copy that is made on each access, modifying it does not
+        modify the template"""
 
-                range_end = index_value
-                return True
+        return [list(s) for s in self._sections]
 
-            assert range_start == INVALID_INDEX
-            assert range_end == INVALID_INDEX
-            range_start = index_value
-            range_end = index_value
+    def match(self, path: 'Sequence[int]') -> bool:
+        sections = self._sections
 
+        if len(sections) != len(path):
             return False
 
-        def apply_new_range() -> None:
-            nonlocal range_start, range_end, section_started
-
-            assert range_start <= MAX_INDEX_VALUE
-            assert range_end <= MAX_INDEX_VALUE
-
-            if section_started:
-                sections.append([(range_start, range_end)])
-                section_started = False
-            else:
-                prev_range_start, prev_range_end = sections[-1][-1]
-                assert prev_range_start <= MAX_INDEX_VALUE
-                assert prev_range_end <= MAX_INDEX_VALUE
-
-                if prev_range_end + 1 == range_start:
-                    sections[-1][-1] = (prev_range_start, range_end)
-                else:
-                    sections[-1].append((range_start, range_end))
+        if self._match_with_bisect:
+            return self._match_bisect(path)
 
-            assert len(sections) <= max_sections
-            assert len(sections[-1]) <= max_ranges_per_section
-
-            range_start = INVALID_INDEX
-            range_end = INVALID_INDEX
-
-        def check_range_correctness(was_open: bool, *, is_last: bool) -> None:
-            assert range_start <= MAX_INDEX_VALUE
-            assert range_end <= MAX_INDEX_VALUE
-
-            if range_start == 0 and range_end == MAX_INDEX_VALUE:
-                err(BIP32TemplateExceptionRangeEqualsWildcard)
-
-            num_ranges = get_num_ranges_in_last_section()
-
-            if range_start == range_end:
-                if is_last and num_ranges == 0:
-                    err(BIP32TemplateExceptionSingleIndexAsRange)
-                if was_open:
-                    err(BIP32TemplateExceptionRangeStartEqualsEnd)
-
-            if range_start > range_end:
-                err(BIP32TemplateExceptionRangeOrderBad)
-
-            if num_ranges > 0:
-                prev_range_start, prev_range_end = sections[-1][-1]
-                assert prev_range_start <= MAX_INDEX_VALUE
-                assert prev_range_end <= MAX_INDEX_VALUE
-
-                if is_format_unambiguous and prev_range_end + 1 == range_start:
-                    err(BIP32TemplateExceptionRangeStartNextToPrevious)
-
-                if prev_range_start > range_start:
-                    err(BIP32TemplateExceptionRangeOrderBad)
-
-                if prev_range_start <= range_start \
-                        and prev_range_end >= range_start:
-                    err(BIP32TemplateExceptionRangesIntersect)
-
-        def is_section_hardened(section: Sequence[Tuple[int, int]]) -> bool:
-            assert section
-
-            # all ranges should be hardened if first range start is hardened,
-            # and should be not hardened otherwise
-            is_hardened = section[0][0] >= HARDENED_INDEX_START
-
-            for r_start, r_end in section:
-                if r_start >= HARDENED_INDEX_START:
-                    assert r_end >= HARDENED_INDEX_START
-                    assert is_hardened
+        for i, section in enumerate(sections):
+            v = path[i]
+            for range_start, range_end in section:
+                if v < range_start or v > range_end:
+                    pass
                 else:
-                    assert r_end < HARDENED_INDEX_START
-                    assert not is_hardened
-
-            return is_hardened
-
-        def harden_last_section() -> None:
-            last_section = sections[-1]
-            for idx, (r_start, r_end) in enumerate(last_section):
-                assert r_start <= MAX_INDEX_VALUE
-                assert r_end <= MAX_INDEX_VALUE
-                last_section[idx] = (r_start + HARDENED_INDEX_START,
-                                     r_end + HARDENED_INDEX_START)
-
-        def do_fsm(c: Optional[str]) -> Tuple[Union[State, Success],
-                                              Optional[State]]:
-            nonlocal index_value, range_start, section_started
-
-            if state is State.SECTION_START:
-                section_started = True
-
-                if c is None:
-                    if not sections:
-                        err(BIP32TemplateExceptionPathEmpty)
-                    err(BIP32TemplateExceptionUnexpectedSlash)
-
-                if not is_format_onlypath:
-                    if c in '{*' and len(sections) == max_sections:
-                        err(BIP32TemplateExceptionPathTooLong)
-                    if c == '{':
-                        index_value = INVALID_INDEX
-                        return (State.VALUE, State.RANGE_WITHIN_SECTION)
-                    if c == '*':
-                        range_start = 0
-                        index_value = MAX_INDEX_VALUE
-                        return (State.SECTION_END, None)
-
-                if c == '/':
-                    err(BIP32TemplateExceptionUnexpectedSlash)
-
-                if c.isdigit():
-                    index_value = process_digit(c)
-                    if len(sections) == max_sections:
-                        # Note that any errors in process_digit
-                        # are catched first
-                        err(BIP32TemplateExceptionPathTooLong)
-                    return (State.VALUE, State.SECTION_END)
-
-                raise_unexpected_char_error(c)
-
-            elif state is State.NEXT_SECTION:
-                assert ret_state is None
-                assert index_value == INVALID_INDEX
-
-                if c is None:
-                    return (Success.SUCCESS, None)
-
-                if c == '/':
-                    return (State.SECTION_START, None)
-
-                raise_unexpected_char_error(c)
-
-            elif state is State.RANGE_WITHIN_SECTION:
-                assert not is_format_onlypath
-
-                if c is None:
-                    err(BIP32TemplateExceptionUnexpectedFinish)
-
-                if index_value == INVALID_INDEX:
-                    if c == ' ':
-                        err(BIP32TemplateExceptionUnexpectedSpace)
-                    err(BIP32TemplateExceptionDigitExpected)
-
-                if c == '-':
-                    if range_start != INVALID_INDEX:
-                        raise_unexpected_char_error(c)
-
-                    range_start = index_value
-                    index_value = INVALID_INDEX
-                    return (State.VALUE, State.RANGE_WITHIN_SECTION)
-
-                if c == ',':
-                    if get_num_ranges_in_last_section() == \
-                            max_ranges_per_section - 1:
-                        err(BIP32TemplateExceptionPathSectionTooLong)
-
-                    was_open = finalize_range()
-                    check_range_correctness(was_open, is_last=False)
-                    apply_new_range()
-                    index_value = INVALID_INDEX
-                    return (State.VALUE, State.RANGE_WITHIN_SECTION)
-
-                if c == '}':
-                    was_open = finalize_range()
-                    check_range_correctness(was_open, is_last=True)
-                    return (State.SECTION_END, None)
-
-                raise_unexpected_char_error(c)
-
-            elif state is State.SECTION_END:
-                assert index_value != INVALID_INDEX
-
-                if c == '/' or c is None:
-                    finalize_range()
-                    apply_new_range()
-                    index_value = INVALID_INDEX
-                    return (
-                        Success.SUCCESS if c is None else State.SECTION_START,
-                        None)
-
-                if c in accepted_hardened_markers:
-                    accepted_hardened_markers.clear()
-                    accepted_hardened_markers.add(c)
-                    finalize_range()
-                    apply_new_range()
-
-                    if len(sections) > 1 \
-                            and not is_section_hardened(sections[-2]):
-                        err(BIP32TemplateExceptionGotHardenedAfterUnhardened)
-
-                    harden_last_section()
-                    index_value = INVALID_INDEX
-                    return (State.NEXT_SECTION, None)
-
-                if c in hardened_markers:
-                    err(BIP32TemplateExceptionUnexpectedHardenedMarker)
-
-                raise_unexpected_char_error(c)
-
-            elif state is State.VALUE:
-                assert c is not None
-                index_value = process_digit(c)
-                return (state, ret_state)
-
+                    break
             else:
-                # too cumbersome to enforce the static check without
-                # Enum implementation so just ignore typing check for now
-                _assert_never(state)  # type: ignore
+                return False
 
-        while True:
-
-            c = None  # type: Optional[str]
-            try:
-                c = next(tpl_iter)
-            except StopIteration:
-                c = None
-            else:
-                if not isinstance(c, str):
-                    raise ValueError(
-                        'encountered an element in tpl that is not a string')
-                if len(c) != 1:
-                    raise ValueError(
-                        'encountered an element in tpl with len() != 1')
-
-            position += 1
-
-            # PrefixParserFSM logic starts
-
-            if c == 'm' and position == 1:
-                is_partial = False
-                continue
-
-            if not is_partial and position == 2:
-                if c == '/':
-                    continue
-                raise_unexpected_char_error(c)
-
-            # PrefixParserFSM logic ends
-
-            if state is State.VALUE and (c is None or not c.isdigit()):
-                assert ret_state is not None
-                state = ret_state
-                ret_state = None
+        return True
 
-            new_state, ret_state = do_fsm(c)
-            assert ret_state is not State.VALUE
+    def _match_bisect(self, path: 'Sequence[int]') -> bool:
+        starts = self._starts
+        ends = self._ends
+        offsets = self._offsets
+
+        lo = 0
+        for i, v in enumerate(path):
+            hi = offsets[i+1]
+            # Ranges in a section are sorted and do not intersect,
+            # so only the last range that starts at or before v can match
+            idx = _bisect_right(starts, v, lo, hi) - 1
+            if idx < lo or v > ends[idx]:
+                return False
+            lo = hi
 
-            if c is None:
-                assert new_state is Success.SUCCESS, \
-                    ('Only success state is permitted when data ends, '
-                     'any errors should cause exceptions to be raised')
-                break
+        return True
 
-            assert new_state is not Success.SUCCESS, \
-                ("Success state should not happen if there's still characters "
-                 "left to parse")
+    def match_many(self, paths: 'Any') -> 'Any':
+        """Match many paths at once. If numpy is available, `paths` can be
+        an (N, num_sections) array of indexes, and the result is an (N,)
+        boolean array that can be used as a mask. Without numpy, the result
+        is a list of booleans"""
 
-            # When we are not using Enum (because it is unavailable
-            # in micropython), mypy 0.761 cannot deduce that SUCCESS case
-            # was checked above and new_state can now only contain
-            # State values. Therefore we need this cast
-            state = cast(State, new_state)
+        np = _get_numpy()
+        if not np:
+            return [self.match(p) for p in paths]
 
-        if len(accepted_hardened_markers) == 1:
-            hardened_marker = list(accepted_hardened_markers)[0]
-        else:
-            hardened_marker = ''
+        try:
+            p_arr = np.asarray(paths)
+        except ValueError:  # paths of different lengths
+            p_arr = None
 
-        return cls(sections, is_partial=is_partial,
-                   hardened_marker=hardened_marker,
-                   _accept_params_as_is=True)
+        if p_arr is None or p_arr.ndim != 2:
+            return np.array([self.match(p) for p in paths], dtype=bool)
 
-    def match(self, path: Sequence[int]) -> bool:
-        if len(self.sections) != len(path):
-            return False
+        offsets = self._offsets
+        if p_arr.shape[1] != len(offsets) - 1:
+            return np.zeros(len(p_arr), dtype=bool)
 
-        for i, section in enumerate(self.sections):
-            for range_start, range_end in section:
-                if path[i] < range_start or path[i] > range_end:
-                    pass  # so the condition check is the same as in the spec
-                else:
-                    break  # range match
-            else:
-                return False  # no breaks: no matching range
+        if self._np_section_ranges is None:
+            starts = np.array(self._starts, dtype=np.uint32)
+            ends = np.array(self._ends, dtype=np.uint32)
+            self._np_section_ranges = [
+                (starts[lo:hi], ends[lo:hi])
+                for lo, hi in zip(offsets, offsets[1:])]
 
-        return True
+        result = np.ones(len(p_arr), dtype=bool)
+        for i, (starts, ends) in enumerate(self._np_section_ranges):
+            col = p_arr[:, i, None]
+            result &= ((col >= starts) & (col <= ends)).any(axis=1)
 
-    def to_path(self) -> Optional[List[int]]:
-        path = []
-        for s in self.sections:
-            if len(s) > 1:
-                return None
+        return result
 
-            if s[0][0] != s[0][1]:
-                return None
+    def to_path(self) -> 'Optional[List[int]]':
+        # each section must contain exactly one single-index range
+        if len(self._starts) != len(self._offsets) - 1:
+            return None
 
-            path.append(s[0][0])
+        if self._starts != self._ends:
+            return None
 
-        return path
+        return list(self._starts)
 
     @classmethod
-    def from_path(cls: Type[T_BIP32Template], path: List[int],
-                  **kwargs: Any) -> T_BIP32Template:
+    def from_path(cls: 'Type[T_BIP32Template]', path: 'List[int]',
+                  **kwargs: 'Any') -> 'T_BIP32Template':
         return cls((((v, v), ) for v in path), **kwargs)
 
-    def __eq__(self, other: Any) -> bool:
+    def __eq__(self, other: 'Any') -> bool:
         """Checks for equality of two templates. Note that templates
         with different hardened markers can still be equal"""
 
@@ -638,7 +429,11 @@ class BIP32Template():
         if self.is_partial != other.is_partial:
             return False
 
-        return self.sections == other.sections
+        # array comparison is done on the whole buffers at once,
+        # without creating per-range tuples
+        return (self._offsets == other._offsets
+                and self._starts == other._starts
+                and self._ends == other._ends)
 
     def __repr__(self) -> str:
         hm = ''
@@ -651,16 +446,16 @@ class BIP32Template():
 
     def __str__(self) -> str:
         s_parts = [] if self.is_partial else ['m']
-        for s in self.sections:
+        for is_hardened, section in zip(self._hardened_mask, self._sections):
             r_parts = []
-            is_hardened = None
-            got_many = len(s) > 1  # if more than 1 range, will need brackets
-            for start_unmasked, end_unmasked in s:
-                is_start_hardened = bool(start_unmasked & HARDENED_INDEX_START)
-                assert is_start_hardened == \
-                    bool(end_unmasked & HARDENED_INDEX_START)
-                assert is_hardened is None or is_hardened == is_start_hardened
-                is_hardened = is_start_hardened
+            # if more than 1 range, will need brackets
+            got_many = len(section) > 1
+            for start_unmasked, end_unmasked in section:
+                if __debug__:
+                    assert is_hardened == \
+                        bool(start_unmasked & HARDENED_INDEX_START)
+                    assert is_hardened == \
+                        bool(end_unmasked & HARDENED_INDEX_START)
 
                 start = start_unmasked & HARDENED_INDEX_MASK
                 end = end_unmasked & HARDENED_INDEX_MASK
@@ -669,20 +464,20 @@ class BIP32Template():
                 elif start == 0 and end == MAX_INDEX_VALUE:
                     r_parts.append('*')
                 else:
-                    r_parts.append('{}-{}'.format(start, end))
+                    r_parts.append(str(start) + '-' + str(end))
                     got_many = True  # will need brackets even if only 1 range
 
-            assert is_hardened is not None
+            assert r_parts
 
             hm = ''
             if is_hardened:
                 assert self.hardened_marker
                 hm = self.hardened_marker
 
-            pre = '{' if got_many else ''
-            post = '}' if got_many else ''
-
-            s_parts.append('{}{}{}{}'.format(pre, ",".join(r_parts), post, hm))
+            if got_many:
+                s_parts.append('{' + ','.join(r_parts) + '}' + hm)
+            else:
+                s_parts.append(r_parts[0] + hm)
 
         return '/'.join(s_parts)
 
@@ -0,0 +1,630 @@
+# Copyright 2020 Dmitry Petukhov https://github.com/dgpv
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy
+# of this software and associated documentation files (the "Software"),
+# to deal in the Software without restriction, including without limitation
+# the rights to use, copy, modify, merge, publish, distribute, sublicense,
+# and/or sell copies of the Software, and to permit persons to whom the
+# Software is furnished to do so, subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be included
+# in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR
+# IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY,
+# FITNESS FOR A PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE
+# AUTHORS OR COPYRIGHT HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER
+# LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
+# OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
+# THE SOFTWARE.
+
+# pylama: ignore=C901,E221
+
+# The template parser is kept in this separate module so that it can be
+# optionally compiled into a C extension with mypyc (see setup.py).
+# The compiled module has the same name and takes precedence over this file,
+# and where it is not available (or on micropython), this file is used as is.
+
+# bip32template/__init__.py imports this module only after the constants
+# and exception classes below are defined
+from . import (
+    HARDENED_INDEX_START, MAX_INDEX_VALUE, INVALID_INDEX,
+    BIP32TemplateException,
+    BIP32TemplateExceptionUnexpectedHardenedMarker,
+    BIP32TemplateExceptionUnexpectedSpace,
+    BIP32TemplateExceptionUnexpectedCharacter,
+    BIP32TemplateExceptionUnexpectedFinish,
+    BIP32TemplateExceptionUnexpectedSlash,
+    BIP32TemplateExceptionInvalidCharacter,
+    BIP32TemplateExceptionIndexTooBig,
+    BIP32TemplateExceptionIndexHasLeadingZero,
+    BIP32TemplateExceptionPathEmpty,
+    BIP32TemplateExceptionPathTooLong,
+    BIP32TemplateExceptionPathSectionTooLong,
+    BIP32TemplateExceptionRangesIntersect,
+    BIP32TemplateExceptionRangeOrderBad,
+    BIP32TemplateExceptionRangeEqualsWildcard,
+    BIP32TemplateExceptionSingleIndexAsRange,
+    BIP32TemplateExceptionRangeStartEqualsEnd,
+    BIP32TemplateExceptionRangeStartNextToPrevious,
+    BIP32TemplateExceptionGotHardenedAfterUnhardened,
+    BIP32TemplateExceptionDigitExpected
+)
+
+# typing module is only needed for the type checkers,
+# see the comment in bip32template/__init__.py
+TYPE_CHECKING = False
+if TYPE_CHECKING:
+    from typing import (
+        List, Tuple, Optional, NoReturn, Type, Callable, ClassVar
+    )
+
+
+# These classes emulate what we could do with Enum
+# With good Enum implementation, we could use mypy to check that all
+# enum variants are exhaustively checked
+# (see https://github.com/python/mypy/issues/6366)
+#
+# But micropyhthon does not have a working Enum implementation,
+# so we are emulating this for a time being.
+#
+# The values are distinct small ints rather than unique object() instances
+# cast to the class type, because mypyc-compiled code checks the types
+# of values at runtime, and would reject such casts. State values are also
+# indexes into the table of FSM state handlers (see _FSM_HANDLERS below)
+
+
+class State:
+    SECTION_START        = 0  # type: ClassVar[int]
+    NEXT_SECTION         = 1  # type: ClassVar[int]
+    RANGE_WITHIN_SECTION = 2  # type: ClassVar[int]
+    SECTION_END          = 3  # type: ClassVar[int]
+
+
+class Success:
+    SUCCESS = 4  # type: ClassVar[int]
+
+
+# Maps ASCII digit bytes to 1, and all other bytes to 0
+_DIGIT_LUT = bytes([1 if 0x30 <= i <= 0x39 else 0 for i in range(256)])
+
+
+def _split_tokens_py(tpl: str) -> 'List[str]':
+    data = tpl.encode()
+    if len(data) != len(tpl):
+        # Non-ASCII characters can only be invalid characters. Replace them
+        # so that byte offsets in data are the same as positions in tpl
+        data = ''.join(c if c < '\x80' else '?' for c in tpl).encode()
+
+    lut = _DIGIT_LUT
+    tokens = []  # type: List[str]
+    digits_start = -1
+    for i, b in enumerate(data):
+        if lut[b]:
+            if digits_start < 0:
+                digits_start = i
+            continue
+        if digits_start >= 0:
+            tokens.append(tpl[digits_start:i])
+            digits_start = -1
+        tokens.append(tpl[i])
+
+    if digits_start >= 0:
+        tokens.append(tpl[digits_start:])
+
+    return tokens
+
+
+# The template is split into tokens with a single regex scan. A token is
+# either a run of decimal digits or a single non-digit character, so that
+# each index value can be converted at once rather than digit by digit.
+_split_tokens = _split_tokens_py  # type: Callable[[str], List[str]]
+
+try:
+    import re
+    _split_tokens = re.compile('[0-9]+|[^0-9]').findall
+except (ImportError, AttributeError):
+    # micropython's `re` module does not have findall(),
+    # use the pure-python tokenizer there
+    pass
+
+
+# Hardened markers that are still accepted are tracked as a bitmask, where
+# bit i stands for hardened_markers[i]. Once a marker is used in the template,
+# only that marker is accepted. Only the first occurrence of duplicate
+# markers gets a bit.
+def _markers_mask(hardened_markers: 'Tuple[str, ...]') -> int:
+    mask = 0
+    for m in hardened_markers:
+        mask |= 1 << hardened_markers.index(m)
+    return mask
+
+
+def _marker_by_mask(hardened_markers: 'Tuple[str, ...]', mask: int) -> str:
+    # Returns the marker if the mask has a single bit set, '' otherwise
+    for i, m in enumerate(hardened_markers):
+        if mask == 1 << i:
+            return m
+    return ''
+
+
+class _ParseState:
+    __slots__ = ('starts', 'ends', 'section_offsets', 'section_is_hardened',
+                 'section_started',
+                 'index_value', 'range_start', 'range_end', 'position',
+                 'max_sections', 'max_ranges_per_section',
+                 'is_format_onlypath', 'is_format_unambiguous',
+                 'hardened_markers', 'accepted_markers_mask')
+
+    def __init__(self, max_sections: int, max_ranges_per_section: int,
+                 is_format_onlypath: bool, is_format_unambiguous: bool,
+                 hardened_markers: 'Tuple[str, ...]') -> None:
+        # Ranges are kept in the same layout as in BIP32Template: flat lists
+        # of range starts and range ends, and the index of the first range
+        # of each section in them. Structure for 0/{3-6,8}/2:
+        # starts: [0, 3, 8, 2], ends: [0, 6, 8, 2], section_offsets: [0, 1, 3]
+        self.starts = []  # type: List[int]
+        self.ends = []  # type: List[int]
+        self.section_offsets = []  # type: List[int]
+        # hardened flag for each of the sections that are already closed
+        self.section_is_hardened = []  # type: List[bool]
+        self.section_started = True
+        self.index_value = INVALID_INDEX
+        self.range_start = INVALID_INDEX
+        self.range_end = INVALID_INDEX
+        self.position = 0
+        self.max_sections = max_sections
+        self.max_ranges_per_section = max_ranges_per_section
+        self.is_format_onlypath = is_format_onlypath
+        self.is_format_unambiguous = is_format_unambiguous
+        self.hardened_markers = hardened_markers
+        self.accepted_markers_mask = _markers_mask(hardened_markers)
+
+
+def _err(st: _ParseState, exc: 'Type[BIP32TemplateException]') -> 'NoReturn':
+    # micropython does not support arguments to exceptions,
+    # so we first create an instance of the exception, set the
+    # attribute, and then raise
+    e_inst = exc()
+    e_inst.position = st.position
+    raise e_inst
+
+
+def _is_digits(tok: str) -> bool:
+    return '0' <= tok[0] <= '9'
+
+
+def _get_num_ranges_in_last_section(st: _ParseState) -> int:
+    if st.section_started:
+        return 0
+    return len(st.starts) - st.section_offsets[-1]
+
+
+def _markers_mask_bit(st: _ParseState, c: str) -> int:
+    return 1 << st.hardened_markers.index(c)
+
+
+def _char_error_class(c: str) -> int:
+    if c in ' \t':
+        return 1
+    if c in "m/}{-,*h'" or '0' <= c <= '9':
+        return 2
+    return 0
+
+
+# Error to report for an unexpected character, indexed by the values in
+# _CHAR_ERROR_LUT. The table covers the first 256 code points, characters
+# beyond that are classified by _char_error_class() directly.
+_CHAR_ERRORS = (
+    BIP32TemplateExceptionInvalidCharacter,     # 0
+    BIP32TemplateExceptionUnexpectedSpace,      # 1
+    BIP32TemplateExceptionUnexpectedCharacter,  # 2
+)  # type: Tuple[Type[BIP32TemplateException], ...]
+
+_CHAR_ERROR_LUT = bytes([_char_error_class(chr(i)) for i in range(256)])
+
+
+def _raise_unexpected_char_error(st: _ParseState, c: 'Optional[str]'
+                                 ) -> 'NoReturn':
+    if c is None:
+        _err(st, BIP32TemplateExceptionUnexpectedFinish)
+    # Tokens of more than one character are runs of digits,
+    # so the first character is enough to classify the token
+    code = ord(c[0])
+    if code < 256:
+        _err(st, _CHAR_ERRORS[_CHAR_ERROR_LUT[code]])
+    _err(st, _CHAR_ERRORS[_char_error_class(c)])
+
+
+def _process_index(st: _ParseState, digits: str) -> int:
+    # The errors are reported at the position of the digit that
+    # caused them, as if the digits were processed one by one.
+    # st.position points at the first digit of the token.
+    if digits[0] == '0' and len(digits) > 1:
+        st.position += 1
+        _err(st, BIP32TemplateExceptionIndexHasLeadingZero)
+
+    if len(digits) >= 10:
+        # Without leading zeroes, only the 10th or the 11th digit
+        # can make the value exceed MAX_INDEX_VALUE
+        if int(digits[:10]) > MAX_INDEX_VALUE:
+            st.position += 9
+            _err(st, BIP32TemplateExceptionIndexTooBig)
+        if len(digits) > 10:
+            st.position += 10
+            _err(st, BIP32TemplateExceptionIndexTooBig)
+
+    return int(digits)
+
+
+def _finalize_range(st: _ParseState) -> bool:
+    if st.range_start != INVALID_INDEX:
+        if st.range_end != INVALID_INDEX:
+            # Because we call this funcion from two different
+            # FSM states (RANGE_WITHIN_SECTION and SECTION_END), and
+            # we _change_ range variables here, range can already be
+            # finalized when this function is called. The end of the
+            # range should be the same as the index, though.
+            assert st.range_end == st.index_value
+            return False
+
+        st.range_end = st.index_value
+        return True
+
+    assert st.range_start == INVALID_INDEX
+    assert st.range_end == INVALID_INDEX
+    st.range_start = st.index_value
+    st.range_end = st.index_value
+
+    return False
+
+
+def _apply_new_range(st: _ParseState) -> None:
+    range_start = st.range_start
+    range_end = st.range_end
+    ends = st.ends
+
+    assert range_start <= MAX_INDEX_VALUE
+    assert range_end <= MAX_INDEX_VALUE
+
+    if not st.section_started and ends[-1] + 1 == range_start:
+        # adjacent ranges of the section are merged in place
+        assert ends[-1] <= MAX_INDEX_VALUE
+        ends[-1] = range_end
+    else:
+        if st.section_started:
+            st.section_offsets.append(len(ends))
+            st.section_started = False
+        st.starts.append(range_start)
+        ends.append(range_end)
+
+    assert len(st.section_offsets) <= st.max_sections
+    assert _get_num_ranges_in_last_section(st) <= st.max_ranges_per_section
+
+    st.range_start = INVALID_INDEX
+    st.range_end = INVALID_INDEX
+
+
+def _check_range_correctness(st: _ParseState, was_open: bool, *,
+                             is_last: bool) -> None:
+    range_start = st.range_start
+    range_end = st.range_end
+
+    assert range_start <= MAX_INDEX_VALUE
+    assert range_end <= MAX_INDEX_VALUE
+
+    if range_start == 0 and range_end == MAX_INDEX_VALUE:
+        _err(st, BIP32TemplateExceptionRangeEqualsWildcard)
+
+    num_ranges = _get_num_ranges_in_last_section(st)
+
+    if range_start == range_end:
+        if is_last and num_ranges == 0:
+            _err(st, BIP32TemplateExceptionSingleIndexAsRange)
+        if was_open:
+            _err(st, BIP32TemplateExceptionRangeStartEqualsEnd)
+
+    if range_start > range_end:
+        _err(st, BIP32TemplateExceptionRangeOrderBad)
+
+    if num_ranges > 0:
+        prev_range_start = st.starts[-1]
+        prev_range_end = st.ends[-1]
+        assert prev_range_start <= MAX_INDEX_VALUE
+        assert prev_range_end <= MAX_INDEX_VALUE
+
+        if st.is_format_unambiguous and prev_range_end + 1 == range_start:
+            _err(st, BIP32TemplateExceptionRangeStartNextToPrevious)
+
+        if prev_range_start > range_start:
+            _err(st, BIP32TemplateExceptionRangeOrderBad)
+
+        if prev_range_start <= range_start \
+                and prev_range_end >= range_start:
+            _err(st, BIP32TemplateExceptionRangesIntersect)
+
+
+def _harden_last_section(st: _ParseState) -> None:
+    starts = st.starts
+    ends = st.ends
+    for idx in range(st.section_offsets[-1], len(starts)):
+        assert starts[idx] <= MAX_INDEX_VALUE
+        assert ends[idx] <= MAX_INDEX_VALUE
+        starts[idx] += HARDENED_INDEX_START
+        ends[idx] += HARDENED_INDEX_START
+
+
+def _fsm_section_start(st: _ParseState, c: 'Optional[str]') -> int:
+    st.section_started = True
+
+    if c is None:
+        if not st.section_offsets:
+            _err(st, BIP32TemplateExceptionPathEmpty)
+        _err(st, BIP32TemplateExceptionUnexpectedSlash)
+
+    if not st.is_format_onlypath:
+        if c in '{*' and len(st.section_offsets) == st.max_sections:
+            _err(st, BIP32TemplateExceptionPathTooLong)
+        if c == '{':
+            st.index_value = INVALID_INDEX
+            return State.RANGE_WITHIN_SECTION
+        if c == '*':
+            st.range_start = 0
+            st.index_value = MAX_INDEX_VALUE
+            return State.SECTION_END
+
+    if c == '/':
+        _err(st, BIP32TemplateExceptionUnexpectedSlash)
+
+    if _is_digits(c):
+        if len(st.section_offsets) == st.max_sections:
+            _err(st, BIP32TemplateExceptionPathTooLong)
+        # Note that the errors in the digits that follow
+        # the first one are reported after the check above
+        st.index_value = _process_index(st, c)
+        return State.SECTION_END
+
+    _raise_unexpected_char_error(st, c)
+
+
+def _fsm_next_section(st: _ParseState, c: 'Optional[str]') -> int:
+    assert st.index_value == INVALID_INDEX
+
+    if c is None:
+        return Success.SUCCESS
+
+    if c == '/':
+        return State.SECTION_START
+
+    _raise_unexpected_char_error(st, c)
+
+
+def _fsm_range_within_section(st: _ParseState, c: 'Optional[str]') -> int:
+    assert not st.is_format_onlypath
+
+    if c is None:
+        _err(st, BIP32TemplateExceptionUnexpectedFinish)
+
+    if st.index_value == INVALID_INDEX:
+        if _is_digits(c):
+            st.index_value = _process_index(st, c)
+            return State.RANGE_WITHIN_SECTION
+        if c == ' ':
+            _err(st, BIP32TemplateExceptionUnexpectedSpace)
+        _err(st, BIP32TemplateExceptionDigitExpected)
+
+    if c == '-':
+        if st.range_start != INVALID_INDEX:
+            _raise_unexpected_char_error(st, c)
+
+        st.range_start = st.index_value
+        st.index_value = INVALID_INDEX
+        return State.RANGE_WITHIN_SECTION
+
+    if c == ',':
+        if _get_num_ranges_in_last_section(st) == \
+                st.max_ranges_per_section - 1:
+            _err(st, BIP32TemplateExceptionPathSectionTooLong)
+
+        was_open = _finalize_range(st)
+        _check_range_correctness(st, was_open, is_last=False)
+        _apply_new_range(st)
+        st.index_value = INVALID_INDEX
+        return State.RANGE_WITHIN_SECTION
+
+    if c == '}':
+        was_open = _finalize_range(st)
+        _check_range_correctness(st, was_open, is_last=True)
+        return State.SECTION_END
+
+    _raise_unexpected_char_error(st, c)
+
+
+def _fsm_section_end(st: _ParseState, c: 'Optional[str]') -> int:
+    assert st.index_value != INVALID_INDEX
+
+    if c == '/' or c is None:
+        _finalize_range(st)
+        _apply_new_range(st)
+        st.section_is_hardened.append(False)
+        st.index_value = INVALID_INDEX
+        return Success.SUCCESS if c is None else State.SECTION_START
+
+    if c in st.hardened_markers \
+            and st.accepted_markers_mask & _markers_mask_bit(st, c):
+        st.accepted_markers_mask = _markers_mask_bit(st, c)
+        _finalize_range(st)
+        _apply_new_range(st)
+
+        if st.section_is_hardened and not st.section_is_hardened[-1]:
+            _err(st, BIP32TemplateExceptionGotHardenedAfterUnhardened)
+
+        _harden_last_section(st)
+        st.section_is_hardened.append(True)
+        st.index_value = INVALID_INDEX
+        return State.NEXT_SECTION
+
+    if c in st.hardened_markers:
+        _err(st, BIP32TemplateExceptionUnexpectedHardenedMarker)
+
+    _raise_unexpected_char_error(st, c)
+
+
+# `c` passed to the FSM state handlers is either a single non-digit character,
+# a run of digits, or None when the template has ended.
+# State values are indexes into this tuple.
+_FSM_HANDLERS = (
+    _fsm_section_start,         # State.SECTION_START
+    _fsm_next_section,          # State.NEXT_SECTION
+    _fsm_range_within_section,  # State.RANGE_WITHIN_SECTION
+    _fsm_section_end,           # State.SECTION_END
+)  # type: Tuple[Callable[[_ParseState, Optional[str]], int], ...]
+
+
+if TYPE_CHECKING:
+    # (range starts, range ends, section offsets, section hardened flags,
+    #  sections as tuples of (start, end) tuples).
+    # Offsets have an extra entry at the end, equal to the number of ranges
+    _ParseRanges = Tuple[Tuple[int, ...], Tuple[int, ...], Tuple[int, ...],
+                         Tuple[bool, ...],
+                         Tuple[Tuple[Tuple[int, int], ...], ...]]
+    # (ranges, is_partial, hardened_marker)
+    _ParseResult = Tuple[_ParseRanges, bool, str]
+
+
+def _parse_concrete_path(tpl: str, max_sections: int,
+                         hardened_markers: 'Tuple[str, ...]'
+                         ) -> 'Optional[_ParseResult]':
+    # Fast path for templates that are just paths, like m/44'/0'/0'/0/5,
+    # that does not need the FSM. Returns None for anything else, including
+    # invalid paths, so that the FSM would parse them and report the errors
+    # at correct positions.
+
+    is_partial = True
+    if tpl.startswith('m/'):
+        is_partial = False
+        tpl = tpl[2:]
+
+    parts = tpl.split('/')
+    if len(parts) > max_sections:
+        return None
+
+    # Same as the FSM, that narrows down accepted markers to the one
+    # that is actually used
+    hardened_marker = _marker_by_mask(hardened_markers,
+                                      _markers_mask(hardened_markers))
+
+    got_unhardened = False
+    values = []
+    section_is_hardened = []
+    for part in parts:
+        marker = part[-1:]
+        if marker and marker in hardened_markers:
+            if got_unhardened:
+                return None
+            if hardened_marker and marker != hardened_marker:
+                return None
+            hardened_marker = marker
+            digits = part[:-1]
+            hardened_bit = HARDENED_INDEX_START
+        else:
+            got_unhardened = True
+            digits = part
+            hardened_bit = 0
+
+        if not digits or digits.strip('0123456789') \
+                or (digits[0] == '0' and len(digits) > 1) \
+                or len(digits) > 10:
+            return None
+
+        v = int(digits)
+        if v > MAX_INDEX_VALUE:
+            return None
+
+        values.append(v + hardened_bit)
+        section_is_hardened.append(hardened_bit != 0)
+
+    # each section has a single range that consists of a single index
+    indexes = tuple(values)
+    ranges = (indexes, indexes, tuple(range(len(indexes) + 1)),
+              tuple(section_is_hardened), tuple(((v, v), ) for v in values))
+
+    return ranges, is_partial, hardened_marker
+
+
+def _parse_template(tpl: str, max_sections: int,
+                    max_ranges_per_section: int,
+                    is_format_onlypath: bool,
+                    is_format_unambiguous: bool,
+                    hardened_markers: 'Tuple[str, ...]'
+                    ) -> '_ParseResult':
+
+    result = _parse_concrete_path(tpl, max_sections, hardened_markers)
+    if result is not None:
+        return result
+
+    is_partial = True
+
+    state = State.SECTION_START
+
+    st = _ParseState(max_sections, max_ranges_per_section,
+                     is_format_onlypath, is_format_unambiguous,
+                     hardened_markers)
+
+    fsm_handlers = _FSM_HANDLERS
+
+    tokens = _split_tokens(tpl)
+
+    # PrefixParserFSM logic: it only looks at the first two tokens,
+    # so it is handled before the main loop
+    position = 1
+    if tokens and tokens[0] == 'm':
+        is_partial = False
+        st.position = 2
+        if len(tokens) < 2 or tokens[1] != '/':
+            _raise_unexpected_char_error(
+                st, tokens[1] if len(tokens) > 1 else None)
+        tokens = tokens[2:]
+        position = 3
+
+    for c in tokens:
+        st.position = position
+        position += len(c)
+
+        state = fsm_handlers[state](st, c)
+
+        assert state != Success.SUCCESS, \
+            ("Success state should not happen if there's still characters "
+             "left to parse")
+
+    # The template has ended
+    st.position = position
+    state = fsm_handlers[state](st, None)
+
+    assert state == Success.SUCCESS, \
+        ('Only success state is permitted when data ends, '
+         'any errors should cause exceptions to be raised')
+
+    hardened_marker = _marker_by_mask(hardened_markers,
+                                      st.accepted_markers_mask)
+
+    st.section_offsets.append(len(st.starts))
+    offsets = st.section_offsets
+    sections = tuple(tuple(zip(st.starts[lo:hi], st.ends[lo:hi]))
+                     for lo, hi in zip(offsets, offsets[1:]))
+    ranges = (tuple(st.starts), tuple(st.ends), tuple(offsets),
+              tuple(st.section_is_hardened), sections)
+
+    return ranges, is_partial, hardened_marker
+
+
+# Parsing result depends only on the template string and parsing options,
+# and is immutable, so it can be shared between BIP32Template instances
+parse_template = _parse_template  # type: Callable[..., _ParseResult]
+
+try:
+    from functools import lru_cache
+    parse_template = lru_cache(maxsize=1024)(_parse_template)
+except ImportError:
+    # micropython does not have functools.lru_cache
+    pass
@@ -8,6 +8,14 @@ here = os.path.abspath(os.path.dirname(__file__))
 with open(os.path.join(here, 'README.md')) as f:
     README = f.read()
 
+# The template parser can be optionally compiled with mypyc, by setting
+# BIP32TEMPLATE_USE_MYPYC=1 in the environment. mypyc is part of mypy,
+# which is then needed at build time.
+ext_modules = []
+if os.environ.get('BIP32TEMPLATE_USE_MYPYC', '0') == '1':
+    from mypyc.build import mypycify  # type: ignore
+    ext_modules = mypycify(['bip32template/_parser.py'])
+
 setup(
     name='bip32template',
     version='0.0.4',
@@ -15,16 +23,19 @@ setup(
     long_description=README,
     long_description_content_type='text/markdown',
     classifiers=[
-        "Programming Language :: Python :: 3.6",
         "Programming Language :: Python :: 3.7",
         "Programming Language :: Python :: 3.8",
         "License :: OSI Approved :: MIT License",
     ],
-    python_requires='>=3.6',
+    python_requires='>=3.7',
     url='https://github.com/dgpv/bip32_template_python_implementation',
     keywords='bitcoin bip32',
     packages=find_packages(),
     zip_safe=False,
+    ext_modules=ext_modules,
     install_requires=[],
+    extras_require={
+        'numpy': ['numpy'],  # for vectorized BIP32Template.match_many()
+    },
     test_suite="tests"
 )
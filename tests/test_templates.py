@@ -25,7 +25,9 @@ import json
 import random
 
 try:
-    from typing import List
+    from typing import List, Tuple, Dict, Optional, Any, Type, Callable
+    # same as the type of BIP32Template.sections
+    _Sections = List[List[Tuple[int, int]]]
 except ImportError:
     pass
 
@@ -82,167 +84,368 @@ errors_table = {
     'error_digit_expected': BIP32TemplateExceptionDigitExpected,
 }
 
+# Flags for error cases that need special treatment in the test
+_ERR_FLAG_UNAMBIGUOUS = 1  # parse with is_format_unambiguous=True
+
+_error_case_flags = {
+    'error_range_start_next_to_previous': _ERR_FLAG_UNAMBIGUOUS,
+}
+
+# (error case name, expected exception, flags), built once
+errors_table_with_flags = tuple(
+    (name, exc, _error_case_flags.get(name, 0))
+    for name, exc in errors_table.items()
+)  # type: Tuple[Tuple[str, Type[BIP32TemplateException], int], ...]
+
+
+_DATA_DIR = os.path.dirname(__file__) + '/data/'
+
+
+# Functions that return the expected error position for the error cases
+# where it is not the position of the last character
+def _fixup_after_end(tcase: str, max_sections: int) -> int:
+    return len(tcase) + 1
+
+
+def _fixup_slash(tcase: str, max_sections: int) -> int:
+    pos = len(tcase)
+    if pos > 1 and tcase[pos-2] != '/':
+        return pos + 1
+    return pos
+
+
+def _fixup_path_too_long(tcase: str, max_sections: int) -> int:
+    num_slashes = tcase.count('/')
+    if tcase.startswith('m/'):
+        num_slashes -= 1
+
+    _check(num_slashes == max_sections,
+           'for testcase "{}": {} slashes, expected {}',
+           tcase, num_slashes, max_sections)
+
+    if tcase[-1] in "'h":
+        return len(tcase) + 1
+    return len(tcase)
+
+
+def _no_fixup(tcase: str, max_sections: int) -> int:
+    return len(tcase)
+
+
+_pos_fixups = {
+    'error_unexpected_finish': _fixup_after_end,
+    'error_path_empty': _fixup_after_end,
+    'error_unexpected_slash': _fixup_slash,
+    'error_path_too_long': _fixup_path_too_long,
+}  # type: Dict[str, Callable[[str, int], int]]
+
+# Test data is read and decoded once, on first use
+_normal_cases = None  # type: Optional[List[Tuple[str, _Sections]]]
+_error_cases = None  # type: Optional[Dict[str, List[str]]]
+
+
+def _load_normal_cases() -> List[Tuple[str, _Sections]]:
+    global _normal_cases
+
+    if _normal_cases is None:
+        _normal_cases = []
+        with open(_DATA_DIR + 'normal_finish') as f:
+            for line in f:
+                tcase, sections_str = json.loads(line)
+
+                # json gives ranges as lists, but sections of templates
+                # have them as tuples
+                sections = [[(start, stop) for start, stop in sec]
+                            for sec in json.loads(sections_str)]
+
+                _normal_cases.append((tcase, sections))
+
+    return _normal_cases
 
-def _extract_path(tpl: BIP32Template, want_nomatch: bool = False) -> List[int]:
+
+def _load_error_cases() -> Dict[str, List[str]]:
+    global _error_cases
+
+    if _error_cases is None:
+        _error_cases = {}
+        for errcase in errors_table:
+            with open(_DATA_DIR + errcase) as f:
+                lines = f.read().split('\n')
+            # Lines are split on '\n' only, because str.splitlines() also
+            # splits on characters like '\r' or '\x1c', that some day may
+            # appear in the templates in the invalid character cases
+            if lines[-1] == '':
+                lines.pop()
+            _error_cases[errcase] = lines
+
+    return _error_cases
+
+
+# Random values for the paths are taken from a separate generator instance,
+# that can be seeded independently of the global one. micropython's random
+# module does not have the Random class, the module itself is used there.
+# Each normal case reseeds it with its own seed, drawn from it beforehand
+# in the main process (see _run_normal_cases()), so that a seeded run
+# gives the same paths whether the cases run in worker processes or not.
+try:
+    _rng = random.Random()  # type: Any
+except AttributeError:
+    _rng = random
+
+
+def _extract_both_paths(tpl: BIP32Template
+                        ) -> Tuple[List[int], List[int]]:
+    # Returns a random path that matches the template, and a path that does
+    # not match it, both made in a single walk over the template sections
+
+    sections = tpl.sections
+    hardened_mask = HARDENED_INDEX_MASK
+    hardened_start = HARDENED_INDEX_START
+    max_index = 0xFFFFFFFF
+    getrandbits = _rng.getrandbits
+    randint = _rng.randint
+
+    # Random bits for the choices below are drawn 32 at a time,
+    # because micropython's getrandbits() can not give more than that
+    rnd_bits = 0
+    num_rnd_bits = 0
 
     path = []
+    nomatch_path = []
     have_nomatch = False
-    for s in tpl.sections:
+    for s in sections:
+        # either a random index in a random range, or the first index
+        value = s[0][0]
+        for start, end in s:
+            if not num_rnd_bits:
+                rnd_bits = getrandbits(32)
+                num_rnd_bits = 32
+            bit = rnd_bits & 1
+            rnd_bits >>= 1
+            num_rnd_bits -= 1
+            if bit:
+                value = randint(start, end)
+                break
+
+        path.append(value)
+
+        if have_nomatch:
+            # the rest of non-matching path can be anything that matches
+            nomatch_path.append(value)
+            continue
+
         for start, end in s:
-            if want_nomatch and not have_nomatch:
-                if (start & HARDENED_INDEX_MASK) != 0:
-                    path.append(start-1)
-                    have_nomatch = True
-                    break
-                if (end | HARDENED_INDEX_START) != 0xFFFFFFFF:
-                    path.append(end+1)
-                    have_nomatch = True
-                    break
-            elif random.choice((True, False)):
-                path.append(random.randint(start, end))
+            if (start & hardened_mask) != 0:
+                nomatch_path.append(start-1)
+                have_nomatch = True
+                break
+            if (end | hardened_start) != max_index:
+                nomatch_path.append(end+1)
+                have_nomatch = True
                 break
         else:
-            path.append(s[0][0])
+            nomatch_path.append(s[0][0])
 
-    if want_nomatch and not have_nomatch:
+    if not have_nomatch:
         # Could not put non-matching value in any position, that means that
         # all sections contain wildcard match. To make a non-matching path,
-        # just flip the last hardened section to unhardened.
+        # just flip the first hardened section to unhardened.
         # If there's no hardened sections, flip first section to hardened
-        have_flipped = False
-        for i, s in enumerate(tpl.sections):
-            assert len(s) == 1
-            start, end = s[0]
-            assert (start & HARDENED_INDEX_MASK) == 0
-            assert (end | HARDENED_INDEX_START) == 0xFFFFFFFF
-            if start >= HARDENED_INDEX_START and not have_flipped:
-                # Found the hardened section, flip
-                path[i] = start ^ HARDENED_INDEX_START
-                have_flipped = True
-                # do not break so all sections are checked with asserts
-
-        if not have_flipped:
+        if __debug__:
+            for s in sections:
+                assert len(s) == 1
+                start, end = s[0]
+                assert (start & hardened_mask) == 0
+                assert (end | hardened_start) == max_index
+
+        i = next((j for j, s in enumerate(sections)
+                  if s[0][0] >= hardened_start), None)
+        if i is not None:
+            # Found the hardened section, flip
+            nomatch_path[i] = sections[i][0][0] ^ hardened_start
+        else:
             # All sections were unhardened, make first section hardened
-            assert tpl.sections[0][0][0] < HARDENED_INDEX_START
-            path[0] = tpl.sections[0][0][0] | HARDENED_INDEX_START
+            assert sections[0][0][0] < hardened_start
+            nomatch_path[0] = sections[0][0][0] | hardened_start
 
-    return path
+    return path, nomatch_path
+
+
+def _extract_path(tpl: BIP32Template, want_nomatch: bool = False) -> List[int]:
+    return _extract_both_paths(tpl)[1 if want_nomatch else 0]
+
+
+NORMAL_MAX_SECTIONS = 3
+NORMAL_MAX_RANGES = 4
+
+
+def _check(cond: bool, what: str, *args: Any) -> None:
+    # Normal cases may be checked in worker processes, outside of
+    # the TestCase, so they can not use its assert methods.
+    # The message is only formatted with args if the check fails.
+    if not cond:
+        raise AssertionError(what.format(*args))
+
+
+def _check_normal_case(tcase: str, sections: _Sections) -> None:
+    parse = BIP32Template.parse
+    from_path = BIP32Template.from_path
+
+    tpl = parse(
+        tcase, max_sections=NORMAL_MAX_SECTIONS,
+        max_ranges_per_section=NORMAL_MAX_RANGES)
+
+    tpl_sections = tpl.sections
+    _check(tpl_sections == sections,
+           'sections {} != {}', tpl_sections, sections)
+
+    _check(BIP32Template(tpl_sections, is_partial=tpl.is_partial) == tpl,
+           'template created from sections differs')
+
+    match_path, nomatch_path = _extract_both_paths(tpl)
+    _check(tpl.match(match_path), 'extracted path does not match')
+    _check(not tpl.match(match_path + [1]), 'longer path matches')
+    _check(not tpl.match(nomatch_path), 'non-matching path matches')
+
+    tpl_str = str(tpl)
+    _check(parse(tpl_str) == tpl,
+           'template parsed from str() differs')
+
+    # Parsing as only-path must succeed exactly when the template is a path
+    expected_path = tpl.to_path()
+
+    try:
+        tpl = parse(
+            tcase, max_sections=NORMAL_MAX_SECTIONS,
+            max_ranges_per_section=NORMAL_MAX_RANGES,
+            is_format_onlypath=True)
+    except BIP32TemplateException:
+        _check(expected_path is None, 'onlypath parse failed for a path')
+    else:
+        path = tpl.to_path()
+        _check(path == expected_path,
+               'onlypath template path {} != {}', path, expected_path)
+        assert path is not None
+        _check(tpl.match(path), 'path does not match its own template')
+        _check(parse(str(tpl)).to_path() == path,
+               'path parsed from str() differs')
+        _check(tpl == from_path(
+                   path, is_partial=tpl.is_partial,
+                   hardened_marker=tpl.hardened_marker),
+               'template created from path differs')
+
+    try:
+        tpl = parse(
+            tcase, max_sections=NORMAL_MAX_SECTIONS,
+            max_ranges_per_section=NORMAL_MAX_RANGES,
+            is_format_unambiguous=True)
+    except BIP32TemplateExceptionRangeStartNextToPrevious:
+        pass
+    else:
+        tpl_str = str(tpl)
+        _check(tpl_str == tcase, 'str() {} != {}', tpl_str, tcase)
+
+
+def _run_one_case(tcase: str, sections: _Sections, seed: int
+                  ) -> Optional[str]:
+    # Returns None on success, or the description of the failed check
+    _rng.seed(seed)
+    try:
+        _check_normal_case(tcase, sections)
+    except AssertionError as e:
+        return 'for testcase "{}": {}'.format(tcase, e)
+    return None
+
+
+def _use_process_pool() -> bool:
+    # Set BIP32TEMPLATE_TESTS_SERIAL=1 to run all cases in this process,
+    # which is easier to debug
+    try:
+        environ = os.environ
+        cpu_count = os.cpu_count()
+        __import__('concurrent.futures')
+    except (AttributeError, ImportError):
+        # micropython
+        return False
+
+    return not environ.get('BIP32TEMPLATE_TESTS_SERIAL') \
+        and (cpu_count or 1) > 1
+
+
+def _run_normal_cases(cases: List[Tuple[str, _Sections]]
+                      ) -> List[Optional[str]]:
+    # The cases are independent of each other, so they can be checked
+    # in parallel on all available cores.
+    # Worker processes get the cases in the order they become free, so
+    # the random values for each case can not come from the shared state
+    # of _rng, and each case gets its own seed instead
+    seeds = [_rng.getrandbits(32) for _ in cases]
+
+    if _use_process_pool():
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor() as ex:
+            return list(ex.map(_run_one_case,
+                               [tcase for tcase, _ in cases],
+                               [sections for _, sections in cases],
+                               seeds, chunksize=64))
+
+    return [_run_one_case(tcase, sections, seed)
+            for (tcase, sections), seed in zip(cases, seeds)]
 
 
 class Test_templates(unittest.TestCase):
     def test_from_spec_data(self) -> None:
-        MAX_SECTIONS = 3
-        MAX_RANGES = 4
+        MAX_SECTIONS = NORMAL_MAX_SECTIONS
+        MAX_RANGES = NORMAL_MAX_RANGES
 
-        with open(os.path.dirname(__file__) + '/data/normal_finish') as f:
-            for line in f:
-                tcase, sections_str = json.loads(line)
+        for res in _run_normal_cases(_load_normal_cases()):
+            self.assertIsNone(res, msg=res)
 
-                sections = []
-                for sec in json.loads(sections_str):
-                    new_sec = []
-                    for start, stop in sec:
-                        new_sec.append((start, stop))
-                    sections.append(new_sec)
+        parse = BIP32Template.parse
 
-                tpl = BIP32Template.parse(
+        def check(tcase: str, expected_exc: Type[BIP32TemplateException],
+                  is_onlypath: bool, is_unambigouos: bool
+                  ) -> BIP32TemplateException:
+            # micropython's assertRaises is too basic,
+            # catch the expected exception directly
+            try:
+                parse(
                     tcase, max_sections=MAX_SECTIONS,
-                    max_ranges_per_section=MAX_RANGES)
-
-                self.assertEqual(tpl.sections, sections)
-
-                self.assertEqual(BIP32Template(tpl.sections,
-                                               is_partial=tpl.is_partial),
-                                 tpl)
-
-                self.assertTrue(tpl.match(_extract_path(tpl)))
-                self.assertFalse(tpl.match(_extract_path(tpl) + [1]))
-                self.assertFalse(
-                    tpl.match(_extract_path(tpl, want_nomatch=True)))
-
-                self.assertEqual(BIP32Template.parse(str(tpl)), tpl)
-
-                try:
-                    tpl = BIP32Template.parse(
-                        tcase, max_sections=MAX_SECTIONS,
-                        max_ranges_per_section=MAX_RANGES,
-                        is_format_onlypath=True)
-                except BIP32TemplateException:
-                    self.assertFalse(tpl.to_path())
-                else:
-                    path = tpl.to_path()
-                    assert path is not None
-                    self.assertTrue(tpl.match(path))
-                    self.assertEqual(
-                        BIP32Template.parse(str(tpl)).to_path(), path)
-                    self.assertEqual(tpl,
-                                     BIP32Template.from_path(
-                                         path, is_partial=tpl.is_partial,
-                                         hardened_marker=tpl.hardened_marker))
-
-                try:
-                    tpl = BIP32Template.parse(
-                        tcase, max_sections=MAX_SECTIONS,
-                        max_ranges_per_section=MAX_RANGES,
-                        is_format_unambiguous=True)
-                except BIP32TemplateExceptionRangeStartNextToPrevious:
-                    pass
-                else:
-                    self.assertEqual(str(tpl), tcase)
-
-        for errcase, expected_exc in errors_table.items():
-            is_unambigouos = (
-                errcase == "error_range_start_next_to_previous")
-            with open(os.path.dirname(__file__) + '/data/' + errcase) as f:
-                for tcase in f:
-                    if tcase.endswith('\n'):
-                        tcase = tcase[:-1]
-
-                    def check(is_onlypath: bool) -> BIP32TemplateException:
-                        # micropython's assertRaises is too basic,
-                        # catch the expected exception directly
-                        try:
-                            BIP32Template.parse(
-                                tcase, max_sections=MAX_SECTIONS,
-                                max_ranges_per_section=MAX_RANGES,
-                                is_format_onlypath=is_onlypath,
-                                is_format_unambiguous=is_unambigouos)
-                        except expected_exc as exc:
-                            return exc
-
-                        raise AssertionError('{} is not raised'
-                                             .format(expected_exc))
-
-                    exc = check(False)
-                    if '{' not in tcase and '*' not in tcase:
-                        exc_onlypath = check(True)
-                        self.assertEqual(str(exc), str(exc_onlypath))
-
-                    expected_pos = len(tcase)
-
-                    if errcase in ('error_unexpected_finish',
-                                   'error_path_empty'):
-                        expected_pos += 1
-                    elif errcase == 'error_unexpected_slash':
-                        if expected_pos > 1 and tcase[expected_pos-2] != '/':
-                            expected_pos += 1
-                    elif errcase == 'error_path_too_long':
-                        if tcase[expected_pos-1] in "'h":
-                            expected_pos += 1
-
-                        num_slashes = tcase.count('/')
-                        if tcase.startswith('m/'):
-                            num_slashes -= 1
-
-                        self.assertEqual(num_slashes, MAX_SECTIONS)
-
-                    # unittest's assertEqual does not print the values,
-                    # so we include them in msg
+                    max_ranges_per_section=MAX_RANGES,
+                    is_format_onlypath=is_onlypath,
+                    is_format_unambiguous=is_unambigouos)
+            except expected_exc as exc:
+                return exc
+
+            raise AssertionError('{} is not raised'.format(expected_exc))
+
+        error_cases = _load_error_cases()
+        for errcase, expected_exc, flags in errors_table_with_flags:
+            is_unambigouos = bool(flags & _ERR_FLAG_UNAMBIGUOUS)
+            fixup = _pos_fixups.get(errcase, _no_fixup)
+            for tcase in error_cases[errcase]:
+                exc = check(tcase, expected_exc, False, is_unambigouos)
+                # The errors must be the same when the template is parsed
+                # as only-path, if it does not use the template syntax
+                if '{' not in tcase and '*' not in tcase:
+                    exc_onlypath = check(tcase, expected_exc, True,
+                                         is_unambigouos)
+                    # the message is defined by the exception class,
+                    # so there is no need to format the exceptions
                     self.assertEqual(
-                        exc.position, expected_pos,
-                        msg=('for error "{}" testcase "{}": {} != {}'
-                             .format(errcase, tcase,
-                                     exc.position, expected_pos)))
+                        (type(exc), exc.position, exc.args),
+                        (type(exc_onlypath), exc_onlypath.position,
+                         exc_onlypath.args))
+
+                expected_pos = fixup(tcase, MAX_SECTIONS)
+
+                # unittest's assertEqual does not print the values,
+                # so we include them in msg
+                self.assertEqual(
+                    exc.position, expected_pos,
+                    msg=('for error "{}" testcase "{}": {} != {}'
+                         .format(errcase, tcase,
+                                 exc.position, expected_pos)))
 
     def test_direct_instantiation(self) -> None:
         with self.assertRaises(BIP32TemplateExceptionPathEmpty):
@@ -288,6 +491,83 @@ class Test_templates(unittest.TestCase):
         self.assertNotEqual(BIP32Template.from_path([0]),
                             BIP32Template.from_path([0], is_partial=True))
 
+    def test_non_ascii_digits(self) -> None:
+        # only ASCII digits are digits for the tokenizer, so other
+        # characters that str.isdigit() accepts are invalid characters
+        for tcase in ('m/٣', 'm/0/²', 'm/0/1٣'):
+            with self.assertRaises(BIP32TemplateExceptionInvalidCharacter):
+                BIP32Template.parse(tcase)
+
+    def test_parse_cache(self) -> None:
+        tpl_str = "m/1'/{0-3,5}/*"
+        tpl = BIP32Template.parse(tpl_str)
+
+        # sections is a copy, modifying it must not affect the template,
+        # nor the data shared with the parse cache
+        sections = tpl.sections
+        sections[1][0] = (7, 7)
+        sections.append([(1, 1)])
+        self.assertEqual(str(tpl), tpl_str)
+        with self.assertRaises(AttributeError):
+            tpl.sections = sections  # type: ignore
+
+        tpl2 = BIP32Template.parse(tpl_str)
+        self.assertTrue(tpl2 is not tpl)
+        self.assertEqual(tpl2, tpl)
+        self.assertEqual(tpl2.sections,
+                         [[(2147483649, 2147483649)],
+                          [(0, 3), (5, 5)],
+                          [(0, 2147483647)]])
+        self.assertEqual(str(tpl2), tpl_str)
+        self.assertEqual(BIP32Template.parse(list(tpl_str)), tpl2)
+
+        # cached result must not be shared between different parsing options
+        with self.assertRaises(BIP32TemplateExceptionPathTooLong):
+            BIP32Template.parse(tpl_str, max_sections=2)
+
+    def test_match_many(self) -> None:
+        tpl = BIP32Template.parse("m/{44,49,84}'/0'/{0-1}/*")
+        paths = [_extract_path(tpl) for _ in range(10)]
+        paths += [_extract_path(tpl, want_nomatch=True) for _ in range(10)]
+        paths.append([0, 0, 0, 0])
+        paths.append([0xFFFFFFFF, 0x80000000, 1, 0x7FFFFFFF])
+
+        expected = [tpl.match(p) for p in paths]
+        self.assertTrue(any(expected))
+        self.assertFalse(all(expected))
+        self.assertEqual(list(tpl.match_many(paths)), expected)
+
+        self.assertEqual(list(tpl.match_many([[0x80000000, 1, 0]])), [False])
+        self.assertEqual(list(tpl.match_many([paths[0], [1]])),
+                         [True, False])
+        self.assertEqual(list(tpl.match_many([])), [])
+
+        # with numpy, the result is always a boolean mask array
+        try:
+            np = __import__('numpy')  # type: Any
+        except ImportError:
+            return
+
+        for p in (paths, [paths[0], [1]], [[1, 2]], []):
+            result = tpl.match_many(p)
+            self.assertTrue(isinstance(result, np.ndarray))
+            self.assertEqual(result.dtype, bool)
+            self.assertEqual(result.shape, (len(p), ))
+
+    def test_match_long_section(self) -> None:
+        # sections with many ranges are matched with bisect
+        tpl = BIP32Template.parse(
+            '{' + ','.join('{}-{}'.format(i*10, i*10+5) for i in range(16))
+            + '}/{0,2}', max_ranges_per_section=16)
+        for i in range(16):
+            for v in (i*10, i*10+3, i*10+5):
+                self.assertTrue(tpl.match([v, 2]))
+            for v in (i*10+6, i*10+9):
+                self.assertFalse(tpl.match([v, 0]))
+            self.assertFalse(tpl.match([i*10+3, 1]))
+        self.assertFalse(tpl.match([0xFFFFFFFF, 0]))
+        self.assertFalse(tpl.match([0]))
+
     def test_repr(self) -> None:
         self.assertEqual(
             repr(BIP32Template.parse("m/{44,49,84}'/0'/0'/{0-1}/{0-50000}")),